@@ -1,12 +1,17 @@
-from concurrent.futures import ThreadPoolExecutor
+from asyncio import to_thread
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from io import BytesIO
 from json import load
 from logging import INFO, Formatter, StreamHandler, getLogger
-from os import unlink
-from re import compile as re_compile
+from multiprocessing import get_context
+from os import SEEK_END, cpu_count, unlink
+from shutil import copyfileobj
 from tempfile import NamedTemporaryFile
-from time import sleep
+from threading import Condition, Lock, local
+from time import monotonic, sleep
 from typing import Any
+from urllib.parse import unquote, urlsplit
 
 from discord import (
     Forbidden,
@@ -18,14 +23,22 @@ from discord import (
     message,
     utils,
 )
-from discord.ext import commands
+from discord.ext import commands, tasks
+from google.auth.transport.requests import Request
 from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaFileUpload, MediaIoBaseUpload
 from PIL import Image
+from pillow_heif import register_heif_opener
 from psutil import virtual_memory
-from pyheif import read as pyheif_read
-from requests import get, head
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+from urllib3.util.retry import Retry
+
+register_heif_opener()
 
 intents = Intents.default()
 intents.message_content = True
@@ -36,35 +49,185 @@ CONFIG = {}
 
 SHARED_DRIVE_ID = ""
 FOLDER_ID = ""
+CHANNEL_NAME = ""
 GUILD = None
 
-IMAGE_EXTENSIONS = (
-    ".png",
-    ".jpg",
-    ".jpeg",
-    ".heic",
-    ".heif",
-)
-VIDEO_EXTENSIONS = (".mp4", ".mov", ".avi", ".mkv")
+IMAGE_EXTENSIONS = frozenset(("png", "jpg", "jpeg", "heic", "heif"))
+VIDEO_EXTENSIONS = frozenset(("mp4", "mov", "avi", "mkv"))
+# Registered MIME types, several differ from "<type>/<extension>"
+MIME_TYPES = {
+    "png": "image/png",
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "heic": "image/heic",
+    "heif": "image/heif",
+    "mp4": "video/mp4",
+    "mov": "video/quicktime",
+    "avi": "video/x-msvideo",
+    "mkv": "video/x-matroska",
+}
 SCOPES = [
     "https://www.googleapis.com/auth/drive",
     "https://www.googleapis.com/auth/drive.file",
 ]
-IMAGE_NAME_PATTERN = re_compile(r"([\w]+\.(?:png|jpg|jpeg|heic|heif))")
-VIDEO_NAME_PATTERN = re_compile(r"([\w]+\.(?:mp4|mov|avi|mkv))")
 
-# google service
-SERVICE = None
+# Drive reports rate limits as 429 or as a 403 with one of these reasons, other
+# 403s (permissions, storage quota, shared drive file limit) are permanent
+RATE_LIMIT_REASONS = frozenset(("userRateLimitExceeded", "rateLimitExceeded"))
+
+# googleapiclient retries 429/5xx and rate limit 403s with jittered exponential backoff
+DRIVE_RETRIES = 5
+
+# Keep OR-joined Drive queries well below the URL length Google accepts
+QUERY_LENGTH_LIMIT = 8000
+
+# Read size used when copying downloads into memory or onto disk
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Last psutil memory reading as [timestamp, available bytes]
+MEMORY_CACHE = [0.0, 0]
+MEMORY_CACHE_TTL = 1.0
+
+# Files under this size skip the resumable session and upload in one request
+SIMPLE_UPLOAD_LIMIT = 5 * 1024 * 1024
+
+# google service account credentials, shared by every worker thread
+CREDENTIALS = None
+
+# Drive discovery document bundled with googleapiclient, kept as JSON text so each
+# thread's build parses a private copy, googleapiclient edits the parsed dict in place
+DRIVE_DISCOVERY = None
+
+# googleapiclient's http object is not thread safe, so each thread builds its own service
+THREAD_LOCAL = local()
+
+# Drive folder ids keyed by thread name, a thread keeps its folder for the life of the bot
+FOLDER_CACHE: dict[str, str] = {}
+# Set once the parent folder is known, only live folders may be cached
+FOLDER_QUERY = ""
+FOLDER_CACHE_LOCK = Lock()
+# Per thread name locks serializing the lookup or creation of that thread's folder
+FOLDER_LOCKS: dict[str, Lock] = {}
+
+# Discord attachment ids already uploaded to each folder, keyed by folder id. File
+# names aren't unique, mobile uploads reuse names like image0.jpg in every message
+FOLDER_ATTACHMENT_IDS: dict[str, set[str]] = {}
+FOLDER_ATTACHMENT_IDS_LOCK = Lock()
+# Per folder locks so a folder is listed once without blocking other folders
+FOLDER_LISTING_LOCKS: dict[str, Lock] = {}
+
+# appProperties key recording which Discord attachment a Drive file came from
+ATTACHMENT_ID_PROPERTY = "discordAttachmentId"
+
+# (folder id, attachment url) pairs currently queued or being transferred
+INFLIGHT: set[tuple[str, str]] = set()
+INFLIGHT_LOCK = Lock()
+
+# (connect, read) timeouts so a stalled CDN connection can't hold a worker forever
+HTTP_TIMEOUT = (5, 30)
+
+# urllib3 can't retry once a streamed body is being read, resets, truncated bodies
+# and read timeouts mid-download restart the whole fetch up to this many times
+DOWNLOAD_ATTEMPTS = 3
+
+# Shared HTTP session so worker threads reuse pooled connections to the Discord CDN,
+# the adapter is mounted at startup once the download worker count is known
+HTTP_SESSION = Session()
+
+# Transient connection errors and 429/5xx responses are retried by urllib3 with
+# jittered backoff that honours Retry-After, other 4xx responses fail immediately
+HTTP_RETRY = Retry(
+    total=3,
+    backoff_factor=0.5,
+    backoff_jitter=0.5,
+    status_forcelist=[429, 500, 502, 503, 504],
+)
 
 # discord commands bot
 bot = commands.Bot(command_prefix="!", intents=intents)
 
-# Create a thread pool for downloading images
-EXECUTOR = ThreadPoolExecutor(max_workers=1)
+# Folder lookups run on their own pool so they overlap with downloads of earlier messages
+FOLDER_EXECUTOR = ThreadPoolExecutor(max_workers=2)
+
+# Thread pool for downloading and uploading attachments, created once the config is loaded
+DOWNLOAD_EXECUTOR = None
+
+# Process pool for HEIC conversion, created once the config is loaded and replaced
+# if a worker dies
+CONVERT_EXECUTOR = None
+CONVERT_EXECUTOR_LOCK = Lock()
 
 logger = getLogger("photo-bot")
 
 
+class UploadController:
+    """Limit concurrent Drive uploads, growing the limit additively on success
+    and halving it whenever Drive throttles us"""
+
+    def __init__(self, permits=4, ceiling=16) -> None:
+        self.limit = float(permits)
+        self.ceiling = ceiling
+        self.active = 0
+        self.condition = Condition()
+
+    def acquire(self) -> None:
+        with self.condition:
+            while self.active >= int(self.limit):
+                self.condition.wait()
+            self.active += 1
+
+    def release(self) -> None:
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def on_success(self) -> None:
+        with self.condition:
+            if self.limit < self.ceiling:
+                self.limit = min(self.ceiling, self.limit + 1 / self.limit)
+                self.condition.notify()
+
+    def on_throttle(self) -> None:
+        with self.condition:
+            self.limit = max(1.0, self.limit / 2)
+            logger.debug(f"Drive throttled uploads, limit now {int(self.limit)}")
+
+
+class RateLimiter:
+    """Token bucket that paces callers to an average of rate calls per second"""
+
+    def __init__(self, rate, burst) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = monotonic()
+        self.lock = Lock()
+
+    def acquire(self) -> None:
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            # Reserve a token now and sleep off any deficit outside the lock
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait:
+            sleep(wait)
+
+
+# Created once the config is loaded, the ceiling is the download worker count
+# since every upload runs on one of those workers
+UPLOAD_CONTROLLER = None
+
+# Drive sustains roughly 3 writes/s per account, bursts above that are absorbed
+# briefly before 403/429s start, reads have a far higher quota
+WRITE_LIMITER = RateLimiter(rate=3, burst=10)
+READ_LIMITER = RateLimiter(rate=10, burst=20)
+
+
 def setup_logger(logger_setup, log_level=INFO):
     logger_setup.setLevel(log_level)
 
@@ -96,24 +259,17 @@ def validate_config(config) -> None:
         exit(1)
 
 
-def get_file_size(url) -> int | None:
-    """Returns the file size in bytes from a URL."""
-    try:
-        response = head(url)
-        if response.status_code == 200 and "Content-Length" in response.headers:
-            logger.debug(f"File size for {url}: {response.headers['Content-Length']}")
-            return int(response.headers["Content-Length"])
-        else:
-            logger.debug("Could not retrieve file size.")
-            return None
-    except Exception as e:
-        logger.error(f"Failed to get file size: {e}")
-        return None
+def available_memory_cached() -> int:
+    """Available system memory, re-read from psutil at most once per MEMORY_CACHE_TTL"""
+    now = monotonic()
+    if now - MEMORY_CACHE[0] > MEMORY_CACHE_TTL:
+        MEMORY_CACHE[:] = [now, virtual_memory().available]
+    return MEMORY_CACHE[1]
 
 
 def is_memory_available(file_size) -> bool:
     """Check if enough memory is available for the given file size."""
-    available_memory = virtual_memory().available
+    available_memory = available_memory_cached()
 
     logger.debug(f"Available memory: {available_memory}")
 
@@ -121,40 +277,67 @@ def is_memory_available(file_size) -> bool:
 
 
 def authenticate_google_drive() -> Any:
-    """Authenticate the user and return a service object"""
+    """Authenticate the service account and return the delegated credentials"""
     logger.info("authenticating google cloud service account")
     creds = Credentials.from_service_account_file(
         "config/service-credentials.json", scopes=SCOPES
     )
-    delegated_creds = creds.with_subject(CONFIG["DELEGATE_EMAIL"])
+    return creds.with_subject(CONFIG["DELEGATE_EMAIL"])
+
 
-    logger.info("creating google cloud service")
-    service = build("drive", "v3", credentials=delegated_creds)
+def get_service() -> Any:
+    """Return the Google Drive service for the current thread, building it on first use"""
+    service = getattr(THREAD_LOCAL, "service", None)
+    if service is None:
+        if not CREDENTIALS:
+            raise Exception("Google Drive service not authenticated")
+
+        logger.info("creating google cloud service")
+        service = build_from_document(DRIVE_DISCOVERY, credentials=CREDENTIALS)
+        THREAD_LOCAL.service = service
     return service
 
 
+def escape_query(value) -> str:
+    """Escape a string for use inside a quoted Drive query literal"""
+    return value.replace("\\", "\\\\").replace("'", "\\'")
+
+
+def is_rate_limited(error) -> bool:
+    """Check if a Drive HttpError is a rate limit rather than a permanent failure"""
+    if error.resp.status == 429:
+        return True
+    if error.resp.status != 403:
+        return False
+
+    # googleapiclient parses Drive's error.errors list into error_details
+    details = getattr(error, "error_details", None)
+    if not isinstance(details, list):
+        return False
+    return any(
+        isinstance(detail, dict) and detail.get("reason") in RATE_LIMIT_REASONS
+        for detail in details
+    )
+
+
 def check_folder_exists(folder_name) -> str | None:
     try:
-        if not SERVICE:
-            raise Exception("Google Drive service not authenticated")
-
-        for _ in range(3):
-            try:
-                response = (
-                    SERVICE.files()
-                    .list(
-                        q=f"'{FOLDER_ID}' in parents and name='{folder_name}'",  # Query to filter by folder parent
-                        corpora="drive",
-                        driveId=SHARED_DRIVE_ID,
-                        includeItemsFromAllDrives=True,
-                        supportsAllDrives=True,
-                    )
-                    .execute()
-                )
-                break
-            except Exception as e:
-                logger.debug(f"Failed to find folder: {e}")
-                sleep(1)
+        service = get_service()
+
+        READ_LIMITER.acquire()
+        response = (
+            service.files()
+            .list(
+                q=f"{FOLDER_QUERY} and name='{escape_query(folder_name)}'",  # Query to filter by folder parent
+                corpora="drive",
+                driveId=SHARED_DRIVE_ID,
+                includeItemsFromAllDrives=True,
+                supportsAllDrives=True,
+                pageSize=1,  # Only the first match is used
+                fields="files(id)",
+            )
+            .execute(num_retries=DRIVE_RETRIES)
+        )
 
         folders = response.get("files", [])
         if folders:
@@ -169,8 +352,7 @@ def check_folder_exists(folder_name) -> str | None:
 def create_folder(folder_name) -> str | None:
 
     try:
-        if not SERVICE:
-            raise Exception("Google Drive service not authenticated")
+        service = get_service()
 
         # Define the metadata for the new folder
         folder_metadata = {
@@ -179,22 +361,17 @@ def create_folder(folder_name) -> str | None:
             "parents": [FOLDER_ID],  # Set the parent folder in the shared drive
         }
 
-        for _ in range(3):
-            # Create the new folder in the specified shared drive folder
-            try:
-                new_folder = (
-                    SERVICE.files()
-                    .create(
-                        body=folder_metadata,
-                        supportsAllDrives=True,  # Ensure it supports shared drives
-                        fields="id, name",
-                    )
-                    .execute()
-                )
-                break
-            except Exception as e:
-                logger.debug(f"Failed to create folder: {e}")
-                sleep(3)
+        # Create the new folder in the specified shared drive folder
+        WRITE_LIMITER.acquire()
+        new_folder = (
+            service.files()
+            .create(
+                body=folder_metadata,
+                supportsAllDrives=True,  # Ensure it supports shared drives
+                fields="id, name",
+            )
+            .execute(num_retries=DRIVE_RETRIES)
+        )
 
         if new_folder:
             return new_folder.get("id")
@@ -205,26 +382,185 @@ def create_folder(folder_name) -> str | None:
     return None
 
 
-def convert_to_jpeg(image_data, file_name, extension):
+def resolve_folder_id(folder_name) -> str | None:
+    """Return the folder id for a thread, looking it up or creating it on a cache miss"""
+    # A single dict read is atomic, only misses and writes take the lock
+    folder_id = FOLDER_CACHE.get(folder_name)
+    if folder_id is not None:
+        return folder_id
+
+    with FOLDER_CACHE_LOCK:
+        folder_lock = FOLDER_LOCKS.setdefault(folder_name, Lock())
+
+    # Held across the lookup so concurrent messages for the same thread share
+    # one lookup and don't create duplicate folders, other threads proceed
+    with folder_lock:
+        folder_id = FOLDER_CACHE.get(folder_name)
+        if folder_id is not None:
+            return folder_id
+
+        folder_id = check_folder_exists(folder_name)
+        if folder_id is None:
+            folder_id = create_folder(folder_name)
+
+        if folder_id:
+            with FOLDER_CACHE_LOCK:
+                FOLDER_CACHE[folder_name] = folder_id
+        return folder_id
+
+
+def forget_folder(folder_id) -> None:
+    """Drop a folder that no longer exists on Drive so the next message recreates it"""
+    with FOLDER_CACHE_LOCK:
+        for folder_name, cached_id in list(FOLDER_CACHE.items()):
+            if cached_id == folder_id:
+                del FOLDER_CACHE[folder_name]
+    with FOLDER_ATTACHMENT_IDS_LOCK:
+        FOLDER_ATTACHMENT_IDS.pop(folder_id, None)
+
+
+def folder_name_queries(folder_names) -> list[str]:
+    """Group folder names into OR-joined Drive queries that stay under QUERY_LENGTH_LIMIT"""
+    queries = []
+    clauses = []
+    length = 0
+    for folder_name in folder_names:
+        clause = f"name='{escape_query(folder_name)}'"
+        if clauses and length + len(clause) > QUERY_LENGTH_LIMIT:
+            queries.append(clauses)
+            clauses = []
+            length = 0
+        clauses.append(clause)
+        length += len(clause) + len(" or ")
+    if clauses:
+        queries.append(clauses)
+
+    return [f"{FOLDER_QUERY} and ({' or '.join(clauses)})" for clauses in queries]
+
+
+def prefetch_folder_ids(folder_names) -> None:
+    """Look up the folders for several threads with a single OR-joined Drive query and cache them"""
+    try:
+        service = get_service()
+
+        with FOLDER_CACHE_LOCK:
+            missing = {name for name in folder_names if name not in FOLDER_CACHE}
+
+        for query in folder_name_queries(missing):
+            page_token = None
+            while True:
+                READ_LIMITER.acquire()
+                response = (
+                    service.files()
+                    .list(
+                        q=query,
+                        corpora="drive",
+                        driveId=SHARED_DRIVE_ID,
+                        includeItemsFromAllDrives=True,
+                        supportsAllDrives=True,
+                        pageSize=1000,
+                        fields="nextPageToken, files(id, name)",
+                        pageToken=page_token,
+                    )
+                    .execute(num_retries=DRIVE_RETRIES)
+                )
+
+                with FOLDER_CACHE_LOCK:
+                    for folder in response.get("files", []):
+                        if folder.get("name") in missing:
+                            FOLDER_CACHE.setdefault(folder["name"], folder.get("id"))
+
+                page_token = response.get("nextPageToken")
+                if not page_token:
+                    break
+
+        logger.info(f"Prefetched folder ids for {len(missing)} threads")
+    except Exception as e:
+        logger.error(f"Failed to prefetch folders: {e}")
+
+
+def folder_attachment_ids(folder_id) -> set[str]:
+    """Return the ids of the attachments already uploaded to a folder, listing it
+    from Drive only once"""
+    # Already listed folders are read without a lock
+    attachment_ids = FOLDER_ATTACHMENT_IDS.get(folder_id)
+    if attachment_ids is not None:
+        return attachment_ids
+
+    with FOLDER_ATTACHMENT_IDS_LOCK:
+        listing_lock = FOLDER_LISTING_LOCKS.setdefault(folder_id, Lock())
+
+    # Held across the listing so concurrent uploads to a new folder share one
+    # listing, other folders proceed
+    with listing_lock:
+        attachment_ids = FOLDER_ATTACHMENT_IDS.get(folder_id)
+        if attachment_ids is not None:
+            return attachment_ids
+
+        try:
+            service = get_service()
+            attachment_ids = set()
+            page_token = None
+
+            while True:
+                READ_LIMITER.acquire()
+                response = (
+                    service.files()
+                    .list(
+                        q=f"'{folder_id}' in parents and trashed=false",
+                        corpora="drive",
+                        driveId=SHARED_DRIVE_ID,
+                        includeItemsFromAllDrives=True,
+                        supportsAllDrives=True,
+                        pageSize=1000,
+                        fields="nextPageToken, files(appProperties)",
+                        pageToken=page_token,
+                    )
+                    .execute(num_retries=DRIVE_RETRIES)
+                )
+                for file in response.get("files", []):
+                    attachment_id = file.get("appProperties", {}).get(
+                        ATTACHMENT_ID_PROPERTY
+                    )
+                    if attachment_id:
+                        attachment_ids.add(attachment_id)
+                page_token = response.get("nextPageToken")
+                if not page_token:
+                    break
+
+            with FOLDER_ATTACHMENT_IDS_LOCK:
+                FOLDER_ATTACHMENT_IDS[folder_id] = attachment_ids
+            logger.debug(
+                f"Found {len(attachment_ids)} uploaded attachments in folder {folder_id}"
+            )
+            return attachment_ids
+        except Exception as e:
+            logger.error(f"Failed to list folder contents: {e}")
+            return set()
+
+
+def convert_to_jpeg(image_data, file_name, extension, quality=90, subsampling="4:2:0"):
+    """Convert HEIC/HEIF bytes to JPEG, runs in CONVERT_EXECUTOR so arguments
+    and results must be picklable"""
     try:
         logger.debug("Converting HEIC/HEIF image")
-        heif_file = pyheif_read(BytesIO(image_data))
-
-        # Convert to a Pillow Image object
-        image = Image.frombytes(
-            heif_file.mode,
-            heif_file.size,
-            heif_file.data,
-            "raw",
-            heif_file.mode,
-            heif_file.stride,
-        )
 
-        img_bytes = BytesIO()
-        image.save(img_bytes, format="JPEG")
-        new_image_data = img_bytes.getvalue()
+        # pillow-heif decodes straight into a Pillow image, no raw pixel copy
+        with BytesIO(image_data) as heif_stream, Image.open(heif_stream) as image:
+            with BytesIO() as img_bytes:
+                image.save(
+                    img_bytes,
+                    format="JPEG",
+                    quality=quality,
+                    subsampling=subsampling,
+                    optimize=False,
+                    progressive=False,
+                )
+                new_image_data = img_bytes.getvalue()
+
         new_extension = "jpeg"
-        new_file_name = file_name.replace("heic", "jpeg")
+        # Only swap the extension, names like "cheick.heic" must keep their stem
+        new_file_name = f"{file_name.rpartition('.')[0]}.{new_extension}"
 
         logger.debug("Converted HEIC/HEIF image")
         return new_image_data, new_file_name, new_extension
@@ -233,283 +569,395 @@ def convert_to_jpeg(image_data, file_name, extension):
         return image_data, file_name, extension
 
 
+def create_convert_executor() -> ProcessPoolExecutor:
+    """Process pool for HEIC conversion, spawned so workers don't inherit the bot's threads"""
+    return ProcessPoolExecutor(
+        max_workers=CONFIG.get(
+            "CONVERT_WORKERS", max(1, min(4, (cpu_count() or 2) - 1))
+        ),
+        mp_context=get_context("spawn"),
+        initializer=setup_logger,
+        initargs=(logger, CONFIG.get("LOGGING", "INFO").upper()),
+    )
+
+
+def convert_in_pool(image_data, file_name, extension):
+    """Run convert_to_jpeg in CONVERT_EXECUTOR, falling back to the original image
+    if the pool fails and replacing the pool when a worker has died"""
+    global CONVERT_EXECUTOR
+    executor = CONVERT_EXECUTOR
+    try:
+        return executor.submit(
+            convert_to_jpeg,
+            image_data,
+            file_name,
+            extension,
+            CONFIG.get("JPEG_QUALITY", 90),
+            CONFIG.get("JPEG_SUBSAMPLING", "4:2:0"),
+        ).result()
+    except Exception as e:
+        logger.error(f"Failed to convert {file_name}, uploading the original: {e}")
+        if isinstance(e, BrokenProcessPool):
+            with CONVERT_EXECUTOR_LOCK:
+                # Only the first thread to notice the broken pool replaces it
+                if CONVERT_EXECUTOR is executor:
+                    CONVERT_EXECUTOR = create_convert_executor()
+                    executor.shutdown(wait=False)
+                    logger.warning("Restarted the HEIC conversion pool")
+        return image_data, file_name, extension
+
+
 def upload(
-    folder_id, stream_data, file_name, extension, thread_name, file_type, file_path=None
+    folder_id,
+    stream_data,
+    file_name,
+    extension,
+    thread_name,
+    file_type,
+    attachment_id,
+    file_path=None,
 ) -> None:
 
     try:
-        if not SERVICE:
-            raise Exception("Google Drive service not authenticated")
+        attachment_id = str(attachment_id)
+        if attachment_id in folder_attachment_ids(folder_id):
+            logger.info(f"Skipping {file_name}, already uploaded to {thread_name}")
+            return
+
+        service = get_service()
         # Define metadata for the new file
         file_metadata = {
             "name": file_name.upper(),
             "parents": [folder_id],  # Specify the parent folder ID
+            # Tags the file with its attachment so reused names aren't skipped
+            "appProperties": {ATTACHMENT_ID_PROPERTY: attachment_id},
         }
 
-        if extension == "jpg":
-            extension = "jpeg"
+        mimetype = MIME_TYPES.get(extension, f"{file_type}/{extension}")
 
         media = None
 
+        # Small files go up in a single multipart request, larger ones use a
+        # resumable session where chunksize=-1 sends the whole file in one request
         if stream_data:
+            stream_data.seek(0, SEEK_END)
+            resumable = stream_data.tell() >= SIMPLE_UPLOAD_LIMIT
+            stream_data.seek(0)
+
             media = MediaIoBaseUpload(
-                stream_data, mimetype=f"{file_type}/{extension}", resumable=True
+                stream_data,
+                mimetype=mimetype,
+                chunksize=-1,
+                resumable=resumable,
             )
         elif file_path:
             media = MediaFileUpload(
-                file_path, mimetype=f"{file_type}/{extension}", resumable=True
+                file_path,
+                mimetype=mimetype,
+                chunksize=-1,
+                resumable=True,
             )
 
+        uploaded_file = None
+
         if media:
-            for _ in range(3):
-                try:
-                    # Upload the file
-                    uploaded_file = (
-                        SERVICE.files()
-                        .create(
-                            body=file_metadata,
-                            media_body=media,
-                            supportsAllDrives=True,  # Ensures compatibility with shared drives
-                            fields="id, name",
-                        )
-                        .execute()
+            UPLOAD_CONTROLLER.acquire()
+            try:
+                WRITE_LIMITER.acquire()
+                # Upload the file, execute drives resumable uploads chunk by chunk
+                uploaded_file = (
+                    service.files()
+                    .create(
+                        body=file_metadata,
+                        media_body=media,
+                        supportsAllDrives=True,  # Ensures compatibility with shared drives
+                        fields="id, name",
                     )
-                    break
-                except Exception as e:
-                    logger.debug(f"Failed to upload image: {e}")
-                    sleep(3)
+                    .execute(num_retries=DRIVE_RETRIES)
+                )
+                UPLOAD_CONTROLLER.on_success()
+            except HttpError as e:
+                if is_rate_limited(e):
+                    UPLOAD_CONTROLLER.on_throttle()
+                elif e.resp.status == 404:
+                    forget_folder(folder_id)
+                logger.debug(f"Failed to upload image: {e}")
+            finally:
+                UPLOAD_CONTROLLER.release()
         else:
             logger.error("No media data to upload")
             return
 
         if uploaded_file:
+            # Only extend a complete listing, a missing entry is listed from Drive later
+            attachment_ids = FOLDER_ATTACHMENT_IDS.get(folder_id)
+            if attachment_ids is not None:
+                attachment_ids.add(attachment_id)
             logger.info(
                 f"Uploaded {file_name} to {thread_name}, File ID: {uploaded_file.get('id')}"
             )
         else:
             logger.warning(f"Failed to upload image: {file_name.upper()}")
-        sleep(1)
     except Exception as e:
         logger.error(f"Failed to upload image: {e}")
 
 
-def download_image(url, file_name, folder_id, extension, thread_name) -> None:
-    try:
-        logger.debug(f"Downloading image from {url}")
-        for _ in range(3):
+def fetch_attachment(url, destination) -> bool:
+    """Stream an attachment into destination, returns False if the CDN refuses it.
+    The fetch restarts from scratch when the connection fails mid-body"""
+    for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+        destination.seek(0)
+        destination.truncate()
+
+        # Failures before the body arrives were already retried by HTTP_RETRY and
+        # propagate, only the copy below is restarted
+        with HTTP_SESSION.get(url, stream=True, timeout=HTTP_TIMEOUT) as response:
+            logger.debug(f"Response {url}: {response.status_code}")
+
+            if response.status_code != 200:
+                return False
+
+            # Stream the body into the destination instead of
+            # materializing response.content and copying it again
+            response.raw.decode_content = True
             try:
-                response = get(url)
-                logger.debug(f"Response {url}: {response.status_code}")
+                copyfileobj(response.raw, destination, COPY_CHUNK_SIZE)
+                return True
+            except (ProtocolError, ReadTimeoutError) as e:
+                if attempt == DOWNLOAD_ATTEMPTS:
+                    raise
+                logger.warning(f"Download of {url} interrupted, retrying: {e}")
 
-                if response.status_code == 200:
-                    image_data = response.content
+        # Back off outside the with block so the broken connection is released
+        sleep(attempt)
+    return False
 
-                    logger.debug(f"Downloaded image from {url}")
 
-                    if "heic" == extension or "heif" == extension:
-                        image_data, file_name, extension = convert_to_jpeg(
-                            image_data, file_name, extension
-                        )
+def download_image(
+    url, file_name, folder_id, extension, thread_name, attachment_id
+) -> None:
+    try:
+        logger.debug(f"Downloading image from {url}")
 
-                    image_data_bytes = BytesIO(image_data)
+        image_stream = BytesIO()
+        if not fetch_attachment(url, image_stream):
+            logger.error(f"Failed to download image: {url}")
+            image_stream.close()
+            return
 
-                    upload(
-                        folder_id,
-                        image_data_bytes,
-                        file_name,
-                        extension,
-                        thread_name,
-                        "image",
-                    )
-                    return
-                else:
-                    logger.debug(f"Failed to download image from {url}")
-            except Exception as e:
-                logger.debug(f"Failed to download image: {e}")
-                sleep(3)
-
-        logger.error(f"Failed to download image: {url}")
+        logger.debug(f"Downloaded image from {url}")
+
+        # Drive stores and previews HEIC natively, converting is opt-in and
+        # can be limited to images over TRANSCODE_BYTES
+        if (
+            CONFIG.get("CONVERT_HEIC", False)
+            and extension in ("heic", "heif")
+            and image_stream.tell() > CONFIG.get("TRANSCODE_BYTES", 0)
+        ):
+            # Decoding is CPU bound, so it runs in a process pool to use
+            # every core while this thread waits
+            image_data, file_name, extension = convert_in_pool(
+                image_stream.getvalue(), file_name, extension
+            )
+            image_stream.close()
+            image_stream = BytesIO(image_data)
+            del image_data
+
+        with image_stream:
+            image_stream.seek(0)
+            upload(
+                folder_id,
+                image_stream,
+                file_name,
+                extension,
+                thread_name,
+                "image",
+                attachment_id,
+            )
     except Exception as e:
         logger.error(f"Failed to download image: {e}")
 
 
-def download_video(folder_id, url, file_name, extension, thread_name) -> None:
+def download_video(
+    folder_id, url, file_name, extension, thread_name, attachment_id, file_size=None
+) -> None:
     try:
 
         logger.debug(f"Downloading video from {url}")
 
-        for _ in range(3):
-            try:
-                file_size = get_file_size(url)
-
-                logger.debug(f"File size: {file_size}")
-
-                response = get(url, stream=True)
-                logger.debug(f"Response {url}: {response.status_code}")
-
-                if response.status_code == 200:
-                    if (
-                        CONFIG["VIDEO_IN_MEMORY"]
-                        and file_size
-                        and is_memory_available(file_size)
-                    ):
-
-                        logger.debug(f"Downloading video from {url} to memory")
-
-                        # Use BytesIO as an in-memory file to store the download stream
-                        video_stream = BytesIO()
-
-                        for chunk in response.iter_content(chunk_size=8192):
-                            video_stream.write(chunk)
-
-                        # Reset the stream position to the start
-                        video_stream.seek(0)
-
-                        logger.debug("Completed download to memory")
-
-                        upload(
-                            folder_id,
-                            video_stream,
-                            file_name,
-                            extension,
-                            thread_name,
-                            "video",
-                        )
-                        return
-
-                    else:
-
-                        logger.debug(f"Downloading video from {url} to disk")
-
-                        # Create a temporary file with 'wb+' mode to read/write binary
-                        temp_file = NamedTemporaryFile(
-                            delete=False, suffix=f".{extension}"
-                        )
-
-                        # Write the video content to the temp file in chunks
-                        for chunk in response.iter_content(chunk_size=8192):
-                            temp_file.write(chunk)
-
-                        temp_file.flush()  # Ensure all data is written
-                        temp_file.seek(
-                            0
-                        )  # Move to the beginning of the file for reading
-
-                        logger.debug(f"Completed download to disk: {temp_file.name}")
-
-                        if temp_file:
-                            try:
-                                upload(
-                                    folder_id,
-                                    None,
-                                    file_name,
-                                    extension,
-                                    thread_name,
-                                    "video",
-                                    temp_file.name,
-                                )
-                            finally:
-                                temp_file.close()  # Close the file
-                                unlink(temp_file.name)
-                                return
-                        else:
-                            logger.error("Failed to download video")
-                            return
-                else:
-                    logger.debug(f"Failed to download image from {url}")
-            except Exception as e:
-                logger.debug(f"Failed to download image: {e}")
-                sleep(3)
+        logger.debug(f"File size: {file_size}")
+
+        video_stream = None
+        temp_file = None
+
+        # The temp file is removed on every path, including failed downloads
+        try:
+            if (
+                CONFIG["VIDEO_IN_MEMORY"]
+                and file_size
+                and is_memory_available(file_size)
+            ):
+
+                logger.debug(f"Downloading video from {url} to memory")
+
+                # Use BytesIO as an in-memory file to store the download stream
+                video_stream = BytesIO()
+                destination = video_stream
+
+            else:
+
+                logger.debug(f"Downloading video from {url} to disk")
+
+                # Create a temporary file with 'wb+' mode to read/write binary
+                temp_file = NamedTemporaryFile(delete=False, suffix=f".{extension}")
+                destination = temp_file
+
+            if not fetch_attachment(url, destination):
+                logger.error(f"Failed to download video: {url}")
+                return
+
+            destination.flush()  # Ensure all data is written
+            destination.seek(0)  # Move to the beginning of the file for reading
+
+            logger.debug(f"Completed download of {url}")
+
+            if video_stream:
+                with video_stream:
+                    upload(
+                        folder_id,
+                        video_stream,
+                        file_name,
+                        extension,
+                        thread_name,
+                        "video",
+                        attachment_id,
+                    )
+            else:
+                upload(
+                    folder_id,
+                    None,
+                    file_name,
+                    extension,
+                    thread_name,
+                    "video",
+                    attachment_id,
+                    temp_file.name,
+                )
+        finally:
+            if temp_file is not None:
+                temp_file.close()
+                unlink(temp_file.name)
     except Exception as e:
         logger.error(f"Failed to download video: {e}")
 
 
-def find_file_name(pattern, url) -> str | None:
+def find_file_name(url) -> tuple[str, str] | None:
+    """Return the sanitized file name and extension of a supported attachment URL"""
     try:
-        return pattern.findall(url)[0].replace(" ", "_").replace("'", "\x27")
+        # The file name is the last path segment, the query string only holds
+        # Discord's signing parameters
+        path = urlsplit(url).path
+        file_name = unquote(path.rsplit("/", 1)[-1]).lower()
+        extension = file_name.rpartition(".")[2]
+        if extension in IMAGE_EXTENSIONS or extension in VIDEO_EXTENSIONS:
+            return file_name.replace(" ", "_"), extension
     except Exception as e:
         logger.debug(f"Failed to find file name: {e}")
     return None
 
 
-def queue_file_downloads(thread_name, attachments, folder_id=None) -> None:
+def finish_download(key) -> None:
+    """Allow an attachment to be queued again once its download has finished"""
+    with INFLIGHT_LOCK:
+        INFLIGHT.discard(key)
 
+
+def queue_file_downloads(thread_name, attachments, folder_id=None) -> list[Future]:
+    futures = []
     try:
-        thread_name = thread_name.replace("'", "\x27")
         logger.debug(f"Thread Name: {thread_name}")
 
         if folder_id is None:
-            folder_id = check_folder_exists(thread_name)
-            if folder_id is None:
-                folder_id = create_folder(thread_name)
+            folder_id = resolve_folder_id(thread_name)
 
         logger.info(f"FOLDER ID: {folder_id}")
 
         if not folder_id:
             logger.debug("Missing folder ID")
-            return
+            return futures
 
         for attachment in attachments:
-            url_lower = attachment.url.lower()
-
-            if any(ext in url_lower for ext in IMAGE_EXTENSIONS):
-
-                logger.debug(f"Found image attachment: {attachment.url}")
-
-                file_name = find_file_name(IMAGE_NAME_PATTERN, url_lower)
-
-                if file_name is None:
-                    logger.debug("Could not image file name")
+            media = find_file_name(attachment.url)
+
+            if media is None:
+                logger.debug(f"No supported file name in {attachment.url}")
+                continue
+
+            file_name, extension = media
+
+            # Skip attachments already on Drive before spending a download on them,
+            # keyed by attachment id since names like image0.jpg repeat
+            if str(attachment.id) in folder_attachment_ids(folder_id):
+                logger.info(f"Skipping {file_name}, already uploaded to {thread_name}")
+                continue
+
+            # Skip attachments already queued for this folder, the query string
+            # holds signing parameters that change between fetches
+            key = (folder_id, attachment.url.split("?", 1)[0])
+            with INFLIGHT_LOCK:
+                if key in INFLIGHT:
+                    logger.debug(f"Already uploading {file_name} to {thread_name}")
                     continue
+                INFLIGHT.add(key)
 
+            if extension in IMAGE_EXTENSIONS:
+                logger.debug(f"Found image attachment: {attachment.url}")
                 logger.debug(f"Found image name: {file_name}")
 
                 # Queue the download task
-                EXECUTOR.submit(
+                future = DOWNLOAD_EXECUTOR.submit(
                     download_image,
                     attachment.url,
                     file_name,
                     folder_id,
-                    file_name.split(".")[-1],
+                    extension,
                     thread_name,
+                    attachment.id,
                 )
 
-            elif any(ext in url_lower for ext in VIDEO_EXTENSIONS):
+            else:
                 logger.debug(f"Found video attachment: {attachment.url}")
-
-                file_name = find_file_name(VIDEO_NAME_PATTERN, url_lower)
-
-                if file_name is None:
-                    logger.debug("Could not find video file name")
-                    continue
-
                 logger.debug(f"Found video name: {file_name}")
 
                 # Queue the download task
-                EXECUTOR.submit(
+                future = DOWNLOAD_EXECUTOR.submit(
                     download_video,
                     folder_id,
                     attachment.url,
                     file_name,
-                    file_name.split(".")[-1],
+                    extension,
                     thread_name,
+                    attachment.id,
+                    attachment.size,  # Discord reports the size, no HEAD needed
                 )
 
-            # Give time for folder and things to be created and completed
-            sleep(3)
+            future.add_done_callback(lambda _, key=key: finish_download(key))
+            futures.append(future)
 
     except Exception as e:
         logger.error(f"Failed to queue image download: {e}")
+    return futures
 
 
 async def process_message(message, thread_name=None, folder_id=None):
-    if "no upload" not in message.content.lower() and message.attachments:
-        logger.debug(f"Recieved attachments: {message.attachments}")
+    # Check attachments first so text-only messages skip lowercasing the content
+    if message.attachments and "no upload" not in message.content.lower():
+        logger.debug("Recieved attachments: %s", message.attachments)
         if not thread_name:
             thread_name = message.channel.name
         logger.info(f"Recieved message in {thread_name}")
 
-        EXECUTOR.submit(
+        FOLDER_EXECUTOR.submit(
             queue_file_downloads, thread_name, message.attachments, folder_id
         )
         await message.add_reaction("👍")
@@ -524,6 +972,17 @@ async def process_message(message, thread_name=None, folder_id=None):
         #     await message.add_reaction("👍")
 
 
+@tasks.loop(minutes=50)
+async def refresh_credentials() -> None:
+    """Refresh the shared access token ahead of its hourly expiry so upload
+    workers don't stall behind a refresh triggered mid-upload"""
+    try:
+        await to_thread(CREDENTIALS.refresh, Request())
+        logger.debug("Refreshed google cloud credentials")
+    except Exception as e:
+        logger.error(f"Failed to refresh credentials: {e}")
+
+
 @bot.event
 async def on_ready() -> None:
     await bot.tree.sync()
@@ -535,16 +994,26 @@ async def on_ready() -> None:
         logger.error("Failed to find guild")
         exit(1)
 
+    if not refresh_credentials.is_running():
+        refresh_credentials.start()
+
+    # Warm the folder cache for every active thread in the upload channel
+    FOLDER_EXECUTOR.submit(
+        prefetch_folder_ids,
+        [thread.name for thread in GUILD.threads if CHANNEL_NAME == str(thread.parent)],
+    )
+
     logger.info(f"Logged in as {bot.user}")
 
 
 @bot.event
 async def on_message(message: message.Message) -> None:
 
-    if isinstance(message.channel, Thread) and CONFIG["CHANNEL_NAME"] == str(
+    if isinstance(message.channel, Thread) and CHANNEL_NAME == str(
         message.channel.parent
     ):
-        logger.debug(f"Recieved message: {message.content}")
+        # Lazy formatting, this runs on the event loop for every message
+        logger.debug("Recieved message: %s", message.content)
         await process_message(message)
 
 
@@ -571,7 +1040,7 @@ async def read_thread(interaction: Interaction, thread_id: str) -> None:
 
             # Read and display all messages in the thread
             async for message in thread.history(limit=None):
-                logger.debug(f"Message: {message}")
+                logger.debug("Message: %s", message)
                 await process_message(message)
         else:
             await interaction.followup.send(
@@ -606,7 +1075,7 @@ async def read_message(
         for channel in GUILD.text_channels:
             try:
                 message = await channel.fetch_message(int(message_id))
-                logger.debug(f"Message found in channel {channel.name}: {message}")
+                logger.debug("Message found in channel %s: %s", channel.name, message)
                 await process_message(message, thread_name=folder_name)
                 await interaction.followup.send(
                     f"Photo/Videos being uploaded to {folder_name}",
@@ -652,11 +1121,36 @@ if __name__ == "__main__":
 
     SHARED_DRIVE_ID = CONFIG["SHARED_DRIVE_ID"]
     FOLDER_ID = CONFIG["PARENT_FOLDER_ID"]
+    CHANNEL_NAME = CONFIG["CHANNEL_NAME"]
+    FOLDER_QUERY = (
+        f"'{FOLDER_ID}' in parents and trashed=false"
+        " and mimeType='application/vnd.google-apps.folder'"
+    )
 
-    SERVICE = authenticate_google_drive()
+    CREDENTIALS = authenticate_google_drive()
+    DRIVE_DISCOVERY = get_static_doc("drive", "v3")
 
-    if not SERVICE:
-        print("Failed to authenticate Google Drive service")
+    if not CREDENTIALS:
+        logger.error("Failed to authenticate Google Drive service")
         exit(1)
 
+    download_workers = CONFIG.get("DOWNLOAD_WORKERS", 8)
+
+    # Keep at least one pooled connection per worker per host, a smaller pool
+    # discards sockets under load and every download after that pays a new handshake
+    HTTP_SESSION.mount(
+        "https://",
+        HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=max(32, download_workers),
+            max_retries=HTTP_RETRY,
+        ),
+    )
+
+    DOWNLOAD_EXECUTOR = ThreadPoolExecutor(max_workers=download_workers)
+    UPLOAD_CONTROLLER = UploadController(
+        permits=min(4, download_workers), ceiling=download_workers
+    )
+    CONVERT_EXECUTOR = create_convert_executor()
+
     bot.run(CONFIG["DISCORD_TOKEN"])